@@ -2,13 +2,37 @@
 This script can split an audio (.wav) file into tracks that are separated by silences between them.
 """
 
+import os
+import re
+import shutil
 import subprocess
+import sys
+import wave
 from argparse import Namespace, ArgumentParser
 from pathlib import Path
-from typing import List
-from math import copysign
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 OFFSET_DEFAULT = 0.3
+SEEK_STEP_DEFAULT = 0.0
+MAX_WORKERS = min(os.cpu_count() or 1, 4)
+# decoder and filter threads of the ffmpeg processes running concurrently in the thread pool,
+# otherwise each of them would start a thread per core
+THREADS_PER_PROCESS = max(1, (os.cpu_count() or 1) // MAX_WORKERS)
+COPY_CHUNK_FRAMES = 1 << 20
+
+# Absolute executable paths together with close_fds=False let subprocess start the processes via posix_spawn
+# instead of fork/exec. Keeping the file descriptors open is safe, since Python creates them non-inheritable.
+FFMPEG = shutil.which('ffmpeg')
+FFPROBE = shutil.which('ffprobe')
+
+# the PCM codecs that the wav muxer accepts
+WAV_PCM_CODECS = {'pcm_u8', 'pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_s64le', 'pcm_f32le', 'pcm_f64le',
+                  'pcm_alaw', 'pcm_mulaw'}
+
+# e.g.  [silencedetect @ 0x55d5c2a0f8c0] silence_end: 540.132 | silence_duration: 2.01
+SILENCE_END_PATTERN = re.compile(r'silence_end:\s*(\d+(?:\.\d+)?)')
 
 
 def init_argument_parser() -> Namespace:
@@ -27,30 +51,142 @@ def init_argument_parser() -> Namespace:
     parser.add_argument('-o', '--offset', type=float, default=OFFSET_DEFAULT,
                         help=f'the offset in seconds before a track starts'
                              f' (if not specified, the default value {OFFSET_DEFAULT} will be taken!)')
+    # optional:
+    parser.add_argument('-s', '--seek-step', type=float, default=SEEK_STEP_DEFAULT,
+                        help='the step in seconds in which the file is pre-scanned for possible silences,'
+                             ' so that only these parts have to be passed through ffmpeg'
+                             ' (at most half the silence duration, requires numpy and an uncompressed .wav file;'
+                             f' if not specified, the default value {SEEK_STEP_DEFAULT} disables the pre-scan)')
     # optional flag:
     parser.add_argument('-x', '--execute', action='store_true',
                         help='if set, the detected audio tracks will be written into current working directory')
+    # optional flag:
+    parser.add_argument('-p', '--precise', action='store_true',
+                        help='if set, the tracks will be cut sample-accurately (directly for uncompressed .wav files,'
+                             ' otherwise by one ffmpeg run per track) instead of being copied by a single ffmpeg run')
     return parser.parse_args()
 
 
-def fetch_silence_ends(file, noise, duration) -> List[float]:
+def fetch_silence_ends(file, noise, duration, start=None, length=None, threads=None) -> List[float]:
     # e.g.
-    # ffmpeg -i recording.wav -af silencedetect=noise=-45dB:d=1.5 -f null - 2> >(grep 'silence_end') | awk '{print $5}'
+    # ffmpeg -nostdin -hide_banner -nostats -i recording.wav -vn -af silencedetect=noise=-45dB:d=1.5 -f null -
     #
-    p1 = subprocess.Popen(
-        ["ffmpeg", "-i", f"{file}", "-af", f"silencedetect=noise={noise}dB:d={duration}",
-         "-f", "null", "-"], stderr=subprocess.PIPE)
-    p2 = subprocess.Popen(["grep", "silence_end"], stdin=p1.stderr, stdout=subprocess.PIPE)
-    p3 = subprocess.Popen(["awk", "{print $5}"], stdin=p2.stdout, stdout=subprocess.PIPE)
+    # silencedetect reports on stderr; it is parsed here instead of piping it through grep and awk.
+    # Its messages are logged at level 'info', so only the banner and the progress stats are suppressed.
+    # The lines are parsed while ffmpeg is still decoding instead of buffering the whole output first.
+    # Undecodable bytes (e.g. Windows-1252 metadata tags in the input info) are replaced.
+    subprocess_args = [FFMPEG, "-nostdin", "-hide_banner", "-nostats"]
+    if start is not None:
+        # only the part [start, start + length] is scanned; the reported times are relative to start
+        subprocess_args += ["-ss", str(start), "-t", str(length)]
+    if threads is not None:
+        # before -i, -threads limits the decoder; -filter_threads limits the filtergraph
+        subprocess_args += ["-threads", str(threads), "-filter_threads", str(threads)]
+    subprocess_args += ["-i", f"{file}",
+                        "-vn", "-af", f"silencedetect=noise={noise}dB:d={duration}", "-f", "null", "-"]
+    silence_ends = []
+    # local names are looked up faster than globals and attributes inside the loop
+    search_silence_end = SILENCE_END_PATTERN.search
+    append_silence_end = silence_ends.append
+    time_offset = start or 0
+    with subprocess.Popen(subprocess_args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          text=True, errors='replace', bufsize=1 << 20, close_fds=False) as process:
+        for line in process.stderr:
+            # the substring test is much cheaper than the regex and rules out all other lines
+            if 'silence_end' not in line:
+                continue
+            match = search_silence_end(line)
+            if match:
+                append_silence_end(float(match.group(1)) + time_offset)
+    return silence_ends
+
+
+def find_silence_candidates(file, noise, seek_step) -> Optional[List[Tuple[float, float]]]:
+    # Pre-scans the file in steps of seek_step seconds and returns the parts (start, length) that may contain
+    # a silence. A step can only belong to a silence if none of its samples exceeds the noise level, so as
+    # long as seek_step is at most half the silence duration no silence is missed.
+    # Returns None if the file cannot be pre-scanned.
+    try:
+        import numpy
+    except ImportError:
+        print('numpy is not installed, the whole file will be scanned')
+        return None
+    try:
+        wav = wave.open(file, 'rb')
+    except (wave.Error, EOFError):
+        print(f'"{file}" is no uncompressed .wav file, the whole file will be scanned')
+        return None
+    with wav:
+        sample_width = wav.getsampwidth()
+        frame_rate = wav.getframerate()
+        dtypes = {1: numpy.uint8, 2: numpy.dtype('<i2'), 4: numpy.dtype('<i4')}
+        if sample_width not in dtypes:
+            print(f'{8 * sample_width} bit samples are not supported, the whole file will be scanned')
+            return None
+        full_scale = 2 ** (8 * sample_width - 1)
+        # 8 bit samples are unsigned with their zero line at 128
+        zero_line = full_scale if sample_width == 1 else 0
+        threshold = 10 ** (noise / 20) * full_scale
+        frames_per_step = max(1, int(seek_step * frame_rate))
 
-    # stdout_result is of type 'bytes'  e.g.  b'540.132\n947.927\n1300.19\n1627.23\n2018.4\n2647.47\n2842\n'
-    stdout_result = p3.communicate()[0]
-    split_mark = bytes(b'\n')
-    return [float(b) for b in stdout_result.split(split_mark) if b != b'']
+        candidates = []
+        step_start = 0
+        while True:
+            data = wav.readframes(frames_per_step)
+            if not data:
+                break
+            samples = numpy.frombuffer(data, dtype=dtypes[sample_width])
+            # converted to int first, otherwise subtracting the zero line wraps around for uint8 samples
+            if int(samples.min()) - zero_line >= -threshold and int(samples.max()) - zero_line <= threshold:
+                # the silence may have started in the previous step and may end in the next one
+                start = max(0.0, (step_start - frames_per_step) / frame_rate)
+                end = (step_start + 2 * frames_per_step) / frame_rate
+                if candidates and start <= candidates[-1][1]:
+                    candidates[-1] = (candidates[-1][0], end)
+                else:
+                    candidates.append((start, end))
+            step_start += frames_per_step
+    return [(start, end - start) for start, end in candidates]
+
+
+def fetch_silence_ends_stepwise(file, noise, duration, seek_step) -> List[float]:
+    candidates = find_silence_candidates(file, noise, seek_step)
+    if candidates is None:
+        return fetch_silence_ends(file, noise, duration)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(
+            lambda candidate: fetch_silence_ends(file, noise, duration, *candidate, threads=THREADS_PER_PROCESS),
+            candidates)
+        return [silence_end for result in results for silence_end in result]
+
+
+def fetch_pcm_codec(file) -> str:
+    # e.g.
+    # ffprobe -v error -select_streams a:0 -show_entries stream=codec_name,sample_fmt,bits_per_raw_sample
+    #         -of default=nw=1 recording.aiff
+    #
+    # returns a PCM codec that a .wav file can hold and that keeps the sample format of the input,
+    # ffmpeg would write 16 bit otherwise
+    output = subprocess.check_output(
+        [FFPROBE, "-v", "error", "-select_streams", "a:0",
+         "-show_entries", "stream=codec_name,sample_fmt,bits_per_raw_sample", "-of", "default=nw=1", f"{file}"],
+        text=True, close_fds=False)
+    stream = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+    codec_name = stream.get('codec_name', '')
+    # big-endian PCM (e.g. from .aiff files) is stored little-endian in .wav files
+    if codec_name.startswith('pcm_') and codec_name.endswith('be'):
+        codec_name = codec_name[:-2] + 'le'
+    if codec_name in WAV_PCM_CODECS:
+        return codec_name
+    # any other input is decoded, so the codec is chosen by the decoded sample format
+    sample_format = stream.get('sample_fmt', '').rstrip('p')
+    if sample_format == 's32':
+        return 'pcm_s24le' if stream.get('bits_per_raw_sample') == '24' else 'pcm_s32le'
+    return {'u8': 'pcm_u8', 'flt': 'pcm_f32le', 'dbl': 'pcm_f64le', 's64': 'pcm_s64le'}.get(sample_format, 'pcm_s16le')
 
 
 def round_away_from_zero(f: float) -> int:
-    return int(f + 0.5 * copysign(1, f))
+    return int(f + 0.5) if f >= 0 else int(f - 0.5)
 
 
 def format_seconds(seconds: int) -> str:
@@ -59,28 +195,100 @@ def format_seconds(seconds: int) -> str:
 
 
 def print_expected_tracks():
-    old_silence_end = 0
-    for number, silence_end in enumerate(silence_ends, start=1):
-        track_duration_in_seconds = round_away_from_zero(silence_end - old_silence_end)
-        print('%.02d.wav' % number, '\t', format_seconds(track_duration_in_seconds))
-        old_silence_end = silence_end
+    track_starts = [0, *silence_ends[:-1]]
+    track_durations_in_seconds = [round_away_from_zero(silence_end - track_start)
+                                  for track_start, silence_end in zip(track_starts, silence_ends)]
+    # written at once instead of one print call per track
+    lines = ['%.02d.wav \t %s' % (number, format_seconds(track_duration_in_seconds))
+             for number, track_duration_in_seconds in enumerate(track_durations_in_seconds, start=1)]
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def is_uncompressed_wav(file) -> bool:
+    try:
+        with wave.open(file, 'rb'):
+            return True
+    except (wave.Error, EOFError):
+        return False
+
+
+def copy_track(file, track, start, end):
+    # the samples of an uncompressed .wav file can be copied directly, without starting ffmpeg
+    with wave.open(file, 'rb') as source, wave.open(track, 'wb') as target:
+        target.setparams(source.getparams())
+        frame_rate = source.getframerate()
+        start_frame = round(start * frame_rate)
+        end_frame = source.getnframes() if end is None else min(round(end * frame_rate), source.getnframes())
+        source.setpos(start_frame)
+        remaining_frames = end_frame - start_frame
+        while remaining_frames > 0:
+            frames_to_copy = min(remaining_frames, COPY_CHUNK_FRAMES)
+            target.writeframesraw(source.readframes(frames_to_copy))
+            remaining_frames -= frames_to_copy
+
+
+def write_track_with_ffmpeg(file, track, start, end, codec):
+    subprocess_args = [FFMPEG, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-ss', str(start)]
+    if end is not None:
+        subprocess_args += ['-t', str(end - start)]
+    subprocess_args += ['-threads', str(THREADS_PER_PROCESS), '-filter_threads', str(THREADS_PER_PROCESS),
+                        '-i', file, '-map', '0:a:0', '-c:a', codec, track]
+    # e.g.  ffmpeg -nostdin -y -ss 0 -t 539.832 -i recording.aiff -map 0:a:0 -c:a pcm_s24le 01.wav
+    #       ffmpeg -nostdin -y -ss 539.832 -t 407.795 -i recording.aiff -map 0:a:0 -c:a pcm_s24le 02.wav
+    #       ffmpeg -nostdin -y -ss 947.627 -i recording.aiff -map 0:a:0 -c:a pcm_s24le 03.wav
+    #
+    # -ss before -i seeks in the input instead of decoding and discarding everything before the track,
+    # the samples after the seek point are still decoded, so the cut stays sample-accurate
+    subprocess.run(subprocess_args, check=True, close_fds=False)
+
+
+def list_tracks(offset) -> List[Tuple[str, float, Optional[float]]]:
+    # (track, start, end) of every track, the last track has no end since it lasts until the end of the file
+    if not silence_ends:
+        return []
+    track_ends = [max(0.0, silence_end - offset) for silence_end in silence_ends[:-1]]
+    track_starts = [0.0, *track_ends]
+    return [('%.02d.wav' % number, track_start, track_end)
+            for number, (track_start, track_end) in enumerate(zip(track_starts, [*track_ends, None]), start=1)]
+
+
+def write_tracks_precisely(file, offset):
+    if is_uncompressed_wav(file):
+        write_track = copy_track
+    else:
+        # e.g. WAVE_FORMAT_EXTENSIBLE or floating point .wav files, which the wave module cannot read
+        write_track = partial(write_track_with_ffmpeg, codec=fetch_pcm_codec(file))
+    # the tracks are independent of each other, so they can be written concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        for track, start, end in list_tracks(offset):
+            print(f'Writing {track}')
+            futures.append(executor.submit(write_track, file, track, start, end))
+        for future in futures:
+            future.result()
 
 
 def write_tracks(file, offset):
-    number_of_tracks = len(silence_ends)
-    old_silence_end = 0
-    for number, silence_end in enumerate(silence_ends, start=1):
-        silence_end -= offset
-        track = '%.02d.wav' % number
-        subprocess_args = ['sox', file, track, 'trim', str(old_silence_end)]
-        if number < number_of_tracks:
-            subprocess_args.append(f'={silence_end}')
+    tracks = list_tracks(offset)
+    if not tracks:
+        return
+    for track, _, _ in tracks:
         print(f'Writing {track}')
-        # e.g.  sox recording.wav 01.wav trim 0 =539.832
-        #       sox recording.wav 02.wav trim 539.832 =947.627
-        #       sox recording.wav 03.wav trim 947.627
-        subprocess.run(subprocess_args)
-        old_silence_end = silence_end
+    # e.g.  ffmpeg -nostdin -hide_banner -loglevel error -i recording.wav -map 0:a:0 -c copy -f segment
+    #              -segment_start_number 1 -reset_timestamps 1 -segment_times 539.832,947.627 %02d.wav
+    #
+    # the segment muxer walks through the input only once and copies the samples without re-encoding them
+    subprocess_args = [FFMPEG, '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', file, '-map', '0:a:0',
+                       '-c', 'copy', '-f', 'segment', '-segment_start_number', '1', '-reset_timestamps', '1']
+    if len(tracks) > 1:
+        cut_points = ','.join(str(end) for _, _, end in tracks[:-1])
+        subprocess_args += ['-segment_times', cut_points]
+    subprocess_args.append('%02d.wav')
+    if subprocess.run(subprocess_args, close_fds=False).returncode != 0:
+        # e.g. codecs that cannot be stored in a .wav file without re-encoding them
+        print('Copying the tracks failed, they will be cut one by one instead')
+        write_tracks_precisely(file, offset)
 
 
 ############## START ##############
@@ -88,6 +296,9 @@ def write_tracks(file, offset):
 args = init_argument_parser()
 # print(args)
 
+if FFMPEG is None or FFPROBE is None:
+    print('ffmpeg and ffprobe must be installed')
+    exit(1)
 if not Path(args.file).exists():
     print(f'File "{args.file}" does not exist')
     exit(1)
@@ -97,8 +308,17 @@ if not args.noise < 0:
 if not args.duration > 0:
     print('Argument "duration" must be >0')
     exit(1)
+if not 0 <= args.seek_step <= args.duration / 2:
+    print('Argument "seek-step" must be >=0 and <=duration/2')
+    exit(1)
 
-silence_ends = fetch_silence_ends(args.file, args.noise, args.duration)
+if args.seek_step > 0:
+    silence_ends = fetch_silence_ends_stepwise(args.file, args.noise, args.duration, args.seek_step)
+else:
+    silence_ends = fetch_silence_ends(args.file, args.noise, args.duration)
 print_expected_tracks()
 if args.execute:
-    write_tracks(args.file, args.offset)
+    if args.precise:
+        write_tracks_precisely(args.file, args.offset)
+    else:
+        write_tracks(args.file, args.offset)